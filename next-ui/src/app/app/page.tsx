@@ -125,6 +125,12 @@ const clamp = (value: number, min: number, max: number) =>
 
 // Calculate dynamic dwell time based on cursor overlap percentage
 // More overlap = faster dwell time, less overlap = slower dwell time
+// crypto.randomUUID only exists in secure contexts (HTTPS/localhost)
+const createRequestId = (): string =>
+  typeof crypto !== 'undefined' && typeof crypto.randomUUID === 'function'
+    ? crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+
 const calculateDwellTime = (overlapRatio: number): number => {
   const MIN_DWELL = DWELL_SELECT_MS; // 750ms - fastest (full overlap)
   const MAX_DWELL = DWELL_SELECT_MS * 2; // 1500ms - slowest (minimum overlap)
@@ -239,6 +245,7 @@ export default function App() {
   const faceApiRef = useRef<typeof import('face-api.js') | null>(null);
   const mediapipeRef = useRef<MediaPipeResources | null>(null);
   const currentAudioRef = useRef<HTMLAudioElement | null>(null);
+  const pendingSpeechRef = useRef<{ id: string; controller: AbortController } | null>(null); // In-flight /tts request
 
   useEffect(() => {
     if (mounted && typeof window !== 'undefined') {
@@ -1015,6 +1022,21 @@ export default function App() {
   }, [activeProfile, activeProfileId, selectedVoice]);
 
   const handleStopSpeech = useCallback(() => {
+    // Abort any in-flight TTS request and tell the proxy to drop the upstream call
+    if (pendingSpeechRef.current) {
+      const { id, controller } = pendingSpeechRef.current;
+      pendingSpeechRef.current = null;
+      controller.abort();
+      fetch(`${PROXY_URL}/api/cancel-tts`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ client_request_id: id }),
+      }).catch(() => {
+        // Proxy unreachable, nothing to cancel
+      });
+    }
     // Stop audio playback
     if (currentAudioRef.current) {
       try {
@@ -1043,6 +1065,11 @@ export default function App() {
     handleStopSpeech();
 
     const { referenceId, name, userId } = resolveVoice();
+    const pendingSpeech = {
+      id: createRequestId(),
+      controller: new AbortController(),
+    };
+    pendingSpeechRef.current = pendingSpeech;
     try {
       setSpeakCooldown(true);
       setTimeout(() => setSpeakCooldown(false), 1500);
@@ -1052,6 +1079,7 @@ export default function App() {
       const processedText = convertTextNumbers(text);
       const response = await fetch(`${PROXY_URL}/tts`, {
         method: 'POST',
+        signal: pendingSpeech.controller.signal,
         headers: {
           'Content-Type': 'application/json',
         },
@@ -1066,6 +1094,7 @@ export default function App() {
             volume: voiceParams.volume,
           },
           user_id: userId,
+          client_request_id: pendingSpeech.id,
         }),
       });
       if (!response.ok) {
@@ -1073,6 +1102,9 @@ export default function App() {
         throw new Error(errorText);
       }
       const blob = await response.blob();
+      if (pendingSpeechRef.current === pendingSpeech) {
+        pendingSpeechRef.current = null;
+      }
       const url = URL.createObjectURL(blob);
       const audio = new Audio(url);
       currentAudioRef.current = audio;
@@ -1091,6 +1123,13 @@ export default function App() {
         currentAudioRef.current = null;
       }
     } catch (error) {
+      if (error instanceof DOMException && error.name === 'AbortError') {
+        // Stopped by the user or superseded by a new utterance
+        return;
+      }
+      if (pendingSpeechRef.current === pendingSpeech) {
+        pendingSpeechRef.current = null;
+      }
       console.error('Speech error', error);
       setStatusMessage(
         'Voice library unavailable. Falling back to system speech synthesis.'
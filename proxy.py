@@ -4,13 +4,22 @@ Fish Audio API Proxy Server
 Solves CORS issues by proxying requests from frontend to Fish Audio API
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, g
 from flask_cors import CORS
 import requests
+import requests.adapters
+import urllib3
 import io
 import os
 import json
 import tempfile
+import threading
+import select
+import socket
+import time
+import atexit
+import hashlib
+import re
 
 # Try to import Fish Audio SDK, fallback to REST API if not available
 try:
@@ -25,7 +34,14 @@ CORS(app)  # Enable CORS for all routes
 
 # Fish Audio API Configuration
 FISH_AUDIO_API_KEY = 'e216cf13d15d4dfa9072558b9c6c9a3e'
-FISH_AUDIO_BASE_URL = 'https://api.fish.audio/v1'
+DEFAULT_FISH_AUDIO_BASE_URL = 'https://api.fish.audio/v1'
+# Can be pointed at a local stand-in (see replay_traffic.py) for load testing
+FISH_AUDIO_BASE_URL = os.environ.get('FISH_AUDIO_BASE_URL', DEFAULT_FISH_AUDIO_BASE_URL)
+
+# The SDK always talks to the real API, so skip it when using a different upstream
+if SDK_AVAILABLE and FISH_AUDIO_BASE_URL != DEFAULT_FISH_AUDIO_BASE_URL:
+    print(f"Using Fish Audio upstream {FISH_AUDIO_BASE_URL}, SDK disabled", flush=True)
+    SDK_AVAILABLE = False
 
 # Initialize Fish Audio SDK client if available
 if SDK_AVAILABLE:
@@ -40,48 +56,651 @@ else:
     fish_audio_client = None
 
 # Voice storage configuration
+# Voice storage is owned by a single serving process (enforced with VOICE_STORAGE_LOCK_FILE);
+# run the proxy with one process and use threads for concurrency.
 VOICE_STORAGE_FILE = "voice_storage.json"
+VOICE_STORAGE_FORMAT = "voice-storage-v2"  # Snapshot layout; older files are a flat user_id -> voice_id map
+VOICE_STORAGE_LOCK_FILE = "voice_storage.lock"
+VOICE_JOURNAL_FILE = "voice_storage.journal"  # Append-only log of changes since last compaction
+VOICE_COMPACTING_JOURNAL_FILE = "voice_storage.journal.compacting"  # Journal being folded into the snapshot
+VOICE_USAGE_FILE = "voice_usage.json"  # Last-used timestamps per user_id
+VOICE_PROFILE_TTL_SECONDS = 90 * 24 * 60 * 60  # Expire voice profiles unused for 90 days
+VOICE_GC_INTERVAL_SECONDS = 60 * 60  # Run garbage collection hourly
+VOICE_JOURNAL_COMPACT_THRESHOLD = 1000  # Compact once this many changes are journaled
+VOICE_LOCK_BATCH_SIZE = 10000  # Max profiles changed per hold of _voice_lock
+VOICE_BULK_LIMIT = 1000  # Max user IDs per bulk lookup
+VOICE_IMPORT_LIMIT = 500000  # Max voice IDs per import (covers a full export)
 
-def load_voice_storage():
-    """Load voice IDs from storage file"""
-    if os.path.exists(VOICE_STORAGE_FILE):
+# In-memory copy of voice storage so lookups don't re-read the file on every request.
+# Writes go to the journal; the snapshot file is only rewritten on compaction.
+# Lock order is _voice_write_lock -> _voice_journal_lock -> _voice_lock:
+#   _voice_write_lock serializes compactions (file writes happen under it alone),
+#   _voice_journal_lock serializes journal appends and every change to _voice_storage,
+#   _voice_lock is only ever held briefly, so /tts lookups never wait on O(n) work.
+_voice_lock = threading.RLock()
+_voice_journal_lock = threading.Lock()
+_voice_write_lock = threading.Lock()
+_voice_lock_file = None
+_voice_storage = None
+_voice_last_used = {}
+_voice_journal_entries = 0
+_voice_journal_generation = 1  # Generation of the live journal; snapshots record the last one folded in
+_voice_storage_dirty = False  # Snapshot file is behind in-memory voice IDs
+_voice_usage_dirty = False  # Usage file is behind in-memory last-used timestamps
+_voice_compact_requested = threading.Event()
+_voice_gc_thread = None
+
+def _write_json_atomic(path, data):
+    """Write JSON to a temp file and swap it in so readers never see a partial file"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+def _load_json_file(path):
+    """Load a JSON object from disk, returning {} if missing or unreadable"""
+    if os.path.exists(path):
         try:
-            with open(VOICE_STORAGE_FILE, 'r') as f:
+            with open(path, 'r') as f:
                 return json.load(f)
         except Exception as e:
-            print(f"Error loading voice storage: {e}")
-            return {}
+            print(f"Error loading {path}: {e}")
     return {}
 
-def save_voice_storage(data):
-    """Save voice IDs to storage file"""
+def _batches(items, size=VOICE_LOCK_BATCH_SIZE):
+    """Split a list into chunks so locks are held for bounded time"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _acquire_voice_storage_lock():
+    """
+    Take an exclusive lock on voice storage for this process.
+    Each process keeps its own in-memory copy, so a second process would
+    overwrite the first one's changes on compaction - refuse to start instead.
+    """
+    global _voice_lock_file
+    lock_file = open(VOICE_STORAGE_LOCK_FILE, 'a+')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        raise RuntimeError(
+            f"{VOICE_STORAGE_FILE} is in use by another proxy process - "
+            "voice storage only supports a single serving process"
+        )
+    _voice_lock_file = lock_file
+
+def _replay_voice_journal(path, storage, snapshot_generation):
+    """
+    Apply journaled changes to storage.
+    Returns (generation, applied); journals already folded into the snapshot are skipped and removed.
+    """
+    generation = None
+    applied = 0
+    if not os.path.exists(path):
+        return generation, applied
     try:
-        with open(VOICE_STORAGE_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written line from a crash - skip it
+                    continue
+                op = entry.get('op')
+                if op == 'generation':
+                    generation = entry['generation']
+                    if generation <= snapshot_generation:
+                        break
+                elif op == 'set':
+                    storage[entry['user_id']] = entry['voice_id']
+                    applied += 1
+                elif op == 'delete':
+                    storage.pop(entry['user_id'], None)
+                    applied += 1
+        if generation is not None and generation <= snapshot_generation:
+            # Compaction wrote the snapshot but crashed before removing this journal
+            os.unlink(path)
+    except Exception as e:
+        print(f"Error replaying voice journal {path}: {e}")
+    return generation, applied
+
+def _ensure_voice_storage_loaded():
+    """Lock, then load snapshot, replay journals and load usage data (once per process)"""
+    global _voice_storage, _voice_last_used, _voice_journal_entries, _voice_journal_generation
+    global _voice_storage_dirty, _voice_usage_dirty
+    if _voice_storage is not None:
+        return
+    with _voice_lock:
+        if _voice_storage is not None:
+            return
+        if _voice_lock_file is None:
+            _acquire_voice_storage_lock()
+
+        snapshot = _load_json_file(VOICE_STORAGE_FILE)
+        if snapshot.get('format') == VOICE_STORAGE_FORMAT:
+            snapshot_generation = snapshot.get('generation', 0)
+            storage = snapshot.get('voices', {})
+        else:
+            snapshot_generation = 0
+            storage = snapshot
+        interrupted_generation, interrupted = _replay_voice_journal(
+            VOICE_COMPACTING_JOURNAL_FILE, storage, snapshot_generation
+        )
+        live_generation, journal_entries = _replay_voice_journal(VOICE_JOURNAL_FILE, storage, snapshot_generation)
+
+        usage = _load_json_file(VOICE_USAGE_FILE)
+        now = time.time()
+        # Profiles without usage data (e.g. created before tracking existed) get a full TTL from now.
+        # Save those defaults so restarts don't keep pushing their expiry back.
+        _voice_last_used = {user_id: usage.get(user_id, now) for user_id in storage}
+        _voice_usage_dirty = any(user_id not in usage for user_id in storage)
+        if os.path.exists(VOICE_JOURNAL_FILE) and live_generation is not None:
+            _voice_journal_generation = live_generation
+        else:
+            _voice_journal_generation = max(snapshot_generation, interrupted_generation or 0) + 1
+        _voice_journal_entries = journal_entries
+        _voice_storage_dirty = bool(interrupted or journal_entries)
+        _voice_storage = storage
+
+def _serialize_voice_journal(entries):
+    """Serialize journal entries (done before taking any lock)"""
+    return ''.join(json.dumps(entry) + '\n' for entry in entries)
+
+def _append_voice_journal(text, count):
+    """Append serialized entries to the journal (call with _voice_journal_lock held)"""
+    global _voice_journal_entries, _voice_storage_dirty
+    if not count:
         return True
+    try:
+        new_journal = not os.path.exists(VOICE_JOURNAL_FILE)
+        with open(VOICE_JOURNAL_FILE, 'a') as f:
+            if new_journal:
+                f.write(json.dumps({'op': 'generation', 'generation': _voice_journal_generation}) + '\n')
+            f.write(text)
     except Exception as e:
-        print(f"Error saving voice storage: {e}")
+        print(f"Error writing voice journal: {e}")
         return False
+    _voice_journal_entries += count
+    _voice_storage_dirty = True
+    if _voice_journal_entries >= VOICE_JOURNAL_COMPACT_THRESHOLD:
+        # Compaction runs on the GC thread, not the request thread that crossed the threshold
+        _voice_compact_requested.set()
+    return True
 
-def get_user_voice_id(user_id="default"):
-    """Get stored voice ID for a user"""
-    storage = load_voice_storage()
-    return storage.get(user_id)
+def _rotate_voice_journal():
+    """Move the live journal aside so new writes start a fresh one (call with _voice_journal_lock held)"""
+    if not os.path.exists(VOICE_JOURNAL_FILE):
+        return
+    if os.path.exists(VOICE_COMPACTING_JOURNAL_FILE):
+        # A previous compaction failed - keep its entries ahead of the new ones
+        with open(VOICE_JOURNAL_FILE, 'r') as journal, open(VOICE_COMPACTING_JOURNAL_FILE, 'a') as compacting:
+            compacting.write(journal.read())
+        os.unlink(VOICE_JOURNAL_FILE)
+    else:
+        os.replace(VOICE_JOURNAL_FILE, VOICE_COMPACTING_JOURNAL_FILE)
+
+def compact_voice_storage():
+    """
+    Rewrite the storage snapshot and usage file if they are out of date.
+    State is copied under _voice_journal_lock; serialization happens outside it
+    so neither lookups nor writes are blocked while large files are written.
+    """
+    global _voice_journal_entries, _voice_journal_generation, _voice_storage_dirty, _voice_usage_dirty
+    _ensure_voice_storage_loaded()
+    with _voice_write_lock:
+        storage = usage = None
+        with _voice_journal_lock:
+            if not _voice_storage_dirty and not _voice_usage_dirty:
+                return True
+            try:
+                if _voice_storage_dirty:
+                    _rotate_voice_journal()
+                    generation = _voice_journal_generation
+                    _voice_journal_generation += 1
+                    _voice_journal_entries = 0
+                    _voice_storage_dirty = False
+                    # Nothing else changes _voice_storage while _voice_journal_lock is held
+                    storage = dict(_voice_storage)
+                if _voice_usage_dirty:
+                    # Clear first so touches during the copy mark it dirty again
+                    _voice_usage_dirty = False
+                    usage = dict(_voice_last_used)
+            except Exception as e:
+                print(f"Error rotating voice journal: {e}")
+                return False
+
+        try:
+            if storage is not None:
+                # The generation marks every journal up to this one as folded in,
+                # so a crash before the unlink below can't replay stale entries
+                _write_json_atomic(VOICE_STORAGE_FILE, {
+                    'format': VOICE_STORAGE_FORMAT,
+                    'generation': generation,
+                    'voices': storage
+                })
+                if os.path.exists(VOICE_COMPACTING_JOURNAL_FILE):
+                    os.unlink(VOICE_COMPACTING_JOURNAL_FILE)
+            if usage is not None:
+                _write_json_atomic(VOICE_USAGE_FILE, usage)
+            return True
+        except Exception as e:
+            print(f"Error compacting voice storage: {e}")
+            with _voice_journal_lock:
+                # Retry on the next compaction; the compacting journal is kept on disk
+                _voice_storage_dirty = _voice_storage_dirty or storage is not None
+                _voice_usage_dirty = _voice_usage_dirty or usage is not None
+            return False
+
+def load_voice_storage():
+    """Load voice IDs from storage"""
+    _ensure_voice_storage_loaded()
+    with _voice_lock:
+        return dict(_voice_storage)
+
+def count_voice_storage():
+    """Number of stored voice IDs"""
+    _ensure_voice_storage_loaded()
+    with _voice_lock:
+        return len(_voice_storage)
+
+def save_voice_storage(data, last_used=None):
+    """Replace all stored voice IDs and rewrite the storage file"""
+    global _voice_storage, _voice_last_used, _voice_storage_dirty, _voice_usage_dirty
+    _ensure_voice_storage_loaded()
+    last_used = last_used or {}
+    now = time.time()
+    storage = dict(data)
+    usage = {
+        user_id: last_used.get(user_id, _voice_last_used.get(user_id, now))
+        for user_id in storage
+    }
+    with _voice_journal_lock:
+        with _voice_lock:
+            _voice_storage = storage
+            _voice_last_used = usage
+        _voice_storage_dirty = True
+        _voice_usage_dirty = True
+    return compact_voice_storage()
+
+def get_user_voice_id(user_id="default", touch=False):
+    """Get stored voice ID for a user, optionally marking it as just used"""
+    global _voice_usage_dirty
+    _ensure_voice_storage_loaded()
+    with _voice_lock:
+        voice_id = _voice_storage.get(user_id)
+        if voice_id and touch:
+            # Only kept in memory - persisted on the next compaction
+            _voice_last_used[user_id] = time.time()
+            _voice_usage_dirty = True
+        return voice_id
+
+def get_user_voice_ids(user_ids):
+    """Get stored voice IDs for many users at once"""
+    _ensure_voice_storage_loaded()
+    with _voice_lock:
+        return {user_id: _voice_storage.get(user_id) for user_id in user_ids}
 
 def save_user_voice_id(user_id, voice_id):
     """Save voice ID for a user"""
-    storage = load_voice_storage()
-    storage[user_id] = voice_id
-    save_voice_storage(storage)
+    return save_user_voice_ids({user_id: voice_id})
+
+def save_user_voice_ids(voices, last_used=None):
+    """Save voice IDs for many users in a single journal write, keeping any given last-used times"""
+    global _voice_usage_dirty
+    _ensure_voice_storage_loaded()
+    last_used = last_used or {}
+    now = time.time()
+    items = list(voices.items())
+    text = _serialize_voice_journal(
+        {'op': 'set', 'user_id': user_id, 'voice_id': voice_id} for user_id, voice_id in items
+    )
+    with _voice_journal_lock:
+        # Journal first so a failed write leaves memory and disk in agreement
+        if not _append_voice_journal(text, len(items)):
+            return False
+        for batch in _batches(items):
+            with _voice_lock:
+                for user_id, voice_id in batch:
+                    _voice_storage[user_id] = voice_id
+                    _voice_last_used[user_id] = last_used.get(user_id, now)
+                _voice_usage_dirty = True
+    return True
 
 def delete_user_voice_id(user_id):
-    """Delete voice ID for a user"""
-    storage = load_voice_storage()
-    if user_id in storage:
-        del storage[user_id]
-        save_voice_storage(storage)
+    """
+    Delete voice ID for a user
+    Returns False if the user had no voice; raises IOError if the change can't be saved.
+    """
+    _ensure_voice_storage_loaded()
+    with _voice_journal_lock:
+        if user_id not in _voice_storage:
+            return False
+        if not _append_voice_journal(_serialize_voice_journal([{'op': 'delete', 'user_id': user_id}]), 1):
+            raise IOError("Failed to write voice storage journal")
+        with _voice_lock:
+            del _voice_storage[user_id]
+            _voice_last_used.pop(user_id, None)
+    return True
+
+def export_voice_storage():
+    """Get all stored voice IDs along with when each was last used"""
+    _ensure_voice_storage_loaded()
+    with _voice_lock:
+        storage = dict(_voice_storage)
+        usage = dict(_voice_last_used)
+    return {
+        user_id: {'voice_id': voice_id, 'last_used': usage.get(user_id)}
+        for user_id, voice_id in storage.items()
+    }
+
+def collect_voice_garbage(now=None):
+    """Expire voice profiles unused for longer than the TTL and compact storage if anything changed"""
+    _ensure_voice_storage_loaded()
+    if now is None:
+        now = time.time()
+    cutoff = now - VOICE_PROFILE_TTL_SECONDS
+    # Scan a copy without holding any lock so lookups keep flowing; candidates are re-checked below
+    candidates = [user_id for user_id, last_used in list(_voice_last_used.items()) if last_used < cutoff]
+    expired = 0
+    for batch in _batches(candidates):
+        with _voice_journal_lock:
+            with _voice_lock:
+                stale = [
+                    user_id for user_id in batch
+                    if user_id in _voice_storage and _voice_last_used.get(user_id, now) < cutoff
+                ]
+            if not stale:
+                continue
+            # Journal the deletes so an interrupted compaction can't bring these profiles back
+            text = _serialize_voice_journal({'op': 'delete', 'user_id': user_id} for user_id in stale)
+            if not _append_voice_journal(text, len(stale)):
+                break
+            with _voice_lock:
+                for user_id in stale:
+                    _voice_storage.pop(user_id, None)
+                    _voice_last_used.pop(user_id, None)
+            expired += len(stale)
+    compacted = compact_voice_storage()
+    return {
+        'expired': expired,
+        'remaining': count_voice_storage(),
+        'compacted': compacted
+    }
+
+def _voice_gc_loop():
+    """Background loop that runs garbage collection hourly and compaction when the journal fills up"""
+    next_gc = time.monotonic() + VOICE_GC_INTERVAL_SECONDS
+    while True:
+        compact_requested = _voice_compact_requested.wait(max(0.0, next_gc - time.monotonic()))
+        _voice_compact_requested.clear()
+        try:
+            if time.monotonic() >= next_gc:
+                next_gc = time.monotonic() + VOICE_GC_INTERVAL_SECONDS
+                stats = collect_voice_garbage()
+                print(f"Voice storage GC: expired {stats['expired']}, {stats['remaining']} remaining", flush=True)
+            elif compact_requested:
+                compact_voice_storage()
+        except Exception as e:
+            print(f"Error in voice storage GC: {e}", flush=True)
+
+def start_voice_storage_gc():
+    """Start the background voice storage garbage collector (once per process)"""
+    global _voice_gc_thread
+    with _voice_lock:
+        if _voice_gc_thread is not None:
+            return
+        _voice_gc_thread = threading.Thread(target=_voice_gc_loop, name='voice-storage-gc', daemon=True)
+        _voice_gc_thread.start()
+
+@app.before_request
+def _start_voice_storage_gc_on_first_request():
+    """Start GC in the process that serves requests (not the debug reloader's watcher process)"""
+    if _voice_gc_thread is None:
+        start_voice_storage_gc()
+
+def _flush_voice_storage():
+    """Persist in-memory last-used timestamps on shutdown"""
+    if _voice_storage is not None:
+        compact_voice_storage()
+
+atexit.register(_flush_voice_storage)
+
+# TTS cancellation configuration
+TTS_UPSTREAM_TIMEOUT_SECONDS = 30  # Default (and max) deadline for a Fish Audio TTS call
+TTS_CANCEL_POLL_SECONDS = 0.1  # How often to check for cancellation while waiting on Fish Audio
+TTS_CANCELLED_STATUS = 499  # Client Closed Request
+
+# In-flight TTS calls keyed by client_request_id, so /api/cancel-tts can abort them
+_tts_lock = threading.Lock()
+_tts_in_flight = {}
+_tts_metrics = {
+    'tts_requests': 0,
+    'tts_completed': 0,
+    'tts_cancelled': 0,
+    'tts_client_disconnects': 0,
+    'tts_deadline_exceeded': 0,
+    'tts_errors': 0,
+    'tts_in_flight': 0
+}
+
+def _count_tts_metric(name, delta=1):
+    """Adjust a TTS metrics counter"""
+    with _tts_lock:
+        _tts_metrics[name] += delta
+
+def _get_tts_deadline():
+    """
+    Work out the absolute deadline for this TTS call.
+    Clients can shorten the default with an X-Request-Timeout-Ms header.
+    """
+    timeout = TTS_UPSTREAM_TIMEOUT_SECONDS
+    header = request.headers.get('X-Request-Timeout-Ms')
+    if header:
+        try:
+            timeout = min(timeout, max(0.0, float(header) / 1000))
+        except ValueError:
+            pass
+    return time.monotonic() + timeout
+
+def _client_disconnected(sock):
+    """Check whether the client closed its connection (readable socket with no data = EOF)"""
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except ValueError:
+        # TLS sockets don't support MSG_PEEK - can't tell, assume still connected
+        return False
+    except OSError:
         return True
-    return False
+
+# Upstream sockets are registered against the call running on the current thread
+# so a cancel can shut them down even while Fish Audio is still generating audio
+_tts_upstream = threading.local()
+
+def _register_upstream_socket(sock):
+    """Remember a freshly connected upstream socket; shut it down at once if already cancelled"""
+    call = getattr(_tts_upstream, 'call', None)
+    if call is None:
+        return
+    call['sock'] = sock
+    if call['cancel'].is_set():
+        _shutdown_upstream_socket(sock)
+
+def _shutdown_upstream_socket(sock):
+    """Unblock any read on the socket; the owning thread then fails fast and closes it"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+class _CancellableHTTPConnection(urllib3.connection.HTTPConnection):
+    def connect(self):
+        super().connect()
+        _register_upstream_socket(self.sock)
+
+class _CancellableHTTPSConnection(urllib3.connection.HTTPSConnection):
+    def connect(self):
+        super().connect()
+        _register_upstream_socket(self.sock)
+
+class _CancellableHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _CancellableHTTPConnection
+
+class _CancellableHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _CancellableHTTPSConnection
+
+class _CancellableAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter whose connections expose their sockets for cancellation"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CancellableHTTPConnectionPool,
+            'https': _CancellableHTTPSConnectionPool
+        }
+
+def _fetch_tts_audio(call, data, headers, deadline):
+    """Run the Fish Audio TTS call on a helper thread so the request thread can stop waiting on cancel"""
+    _tts_upstream.call = call
+    try:
+        timeout = max(0.1, deadline - time.monotonic())
+        # Fresh session per call so the connection (and its socket) belongs only to this call
+        with requests.Session() as session:
+            session.mount('http://', _CancellableAdapter())
+            session.mount('https://', _CancellableAdapter())
+            with session.post(
+                f'{FISH_AUDIO_BASE_URL}/tts',
+                headers=headers,
+                json=data,
+                timeout=timeout,
+                stream=True
+            ) as response:
+                if call['cancel'].is_set():
+                    return
+                call['status_code'] = response.status_code
+                call['headers'] = dict(response.headers)
+                if response.status_code != 200:
+                    call['error_text'] = response.text
+                    return
+                chunks = []
+                for chunk in response.iter_content(chunk_size=16384):
+                    # Stop downloading audio nobody is waiting for
+                    if call['cancel'].is_set() or time.monotonic() >= deadline:
+                        return
+                    chunks.append(chunk)
+                call['content'] = b''.join(chunks)
+    except Exception as e:
+        if not call['cancel'].is_set():
+            call['exception'] = e
+    finally:
+        _tts_upstream.call = None
+        call['done'].set()
+
+def _cancel_tts_call(call):
+    """Signal an in-flight TTS call to stop and shut down its upstream connection"""
+    call['cancel'].set()
+    sock = call.get('sock')
+    if sock is not None:
+        _shutdown_upstream_socket(sock)
+
+# Traffic capture configuration (opt-in: set TRAFFIC_CAPTURE_FILE to enable)
+# Records anonymized /tts and /search-voices request shapes for replay_traffic.py
+TRAFFIC_CAPTURE_FILE = os.environ.get('TRAFFIC_CAPTURE_FILE')
+# Salt and run ID are random per launch so hashed IDs can't be matched across captures.
+# They're stored in the environment so debug-reloader restarts (child processes)
+# keep the same salt and run ID instead of starting a new segment in the same file.
+TRAFFIC_CAPTURE_SALT = os.environ.setdefault('TRAFFIC_CAPTURE_SALT', os.urandom(16).hex())
+TRAFFIC_CAPTURE_RUN = os.environ.setdefault('TRAFFIC_CAPTURE_RUN', os.urandom(4).hex())
+TRAFFIC_CAPTURE_PATHS = ('/tts', '/search-voices', '/api/cancel-tts')
+
+_capture_lock = threading.Lock()
+
+def _anonymize_id(value):
+    """Hash an ID so repeat users/voices stay recognizable without being stored"""
+    if not value:
+        return None
+    digest = hashlib.sha256(f"{TRAFFIC_CAPTURE_SALT}:{value}".encode()).hexdigest()
+    return digest[:16]
+
+def _placeholder_text(text):
+    """Replace text with same-length filler, keeping whitespace so word counts match"""
+    return re.sub(r'\S', 'x', text or '')
+
+def _capture_request_shape():
+    """Build the anonymized shape of the current request"""
+    if request.path == '/tts':
+        data = request.get_json(silent=True) or {}
+        prosody = data.get('prosody') or {}
+        timeout_ms = request.headers.get('X-Request-Timeout-Ms')
+        try:
+            timeout_ms = float(timeout_ms) if timeout_ms else None
+        except ValueError:
+            timeout_ms = None
+        shape = {
+            'path': '/tts',
+            # Links the request to a later /api/cancel-tts so replay can cancel it too
+            'cid': _anonymize_id(data.get('client_request_id') or request.headers.get('X-Client-Request-Id')),
+            'timeout_ms': timeout_ms,
+            'user': _anonymize_id(data.get('user_id')),
+            'ref': _anonymize_id(data.get('reference_id')),
+            'text': _placeholder_text(data.get('text')),
+            'prosody': {'speed': prosody.get('speed', 1.0), 'volume': prosody.get('volume', 0)},
+            'format': data.get('format'),
+            'mp3_bitrate': data.get('mp3_bitrate'),
+            'normalize': data.get('normalize')
+        }
+        # Drop unset fields to keep the capture compact
+        return {key: value for key, value in shape.items() if value is not None}
+    if request.path == '/api/cancel-tts':
+        data = request.get_json(silent=True) or {}
+        return {'path': '/api/cancel-tts', 'cid': _anonymize_id(data.get('client_request_id'))}
+    return {
+        'path': request.path,
+        'title': _placeholder_text(request.args.get('title', '')),
+        'tags': _placeholder_text(request.args.get('tags', '')),
+        'language': request.args.get('language', '')
+    }
+
+@app.before_request
+def _start_traffic_capture():
+    """Snapshot the request before handlers modify it"""
+    if TRAFFIC_CAPTURE_FILE and request.method != 'OPTIONS' and request.path in TRAFFIC_CAPTURE_PATHS:
+        try:
+            g.capture = _capture_request_shape()
+            # Wall-clock time so records stay ordered across process restarts
+            g.capture['ts'] = round(time.time(), 3)
+            g.capture['run'] = TRAFFIC_CAPTURE_RUN
+            g.capture_start = time.monotonic()
+        except Exception as e:
+            print(f"Error capturing request: {e}", flush=True)
+
+@app.after_request
+def _finish_traffic_capture(response):
+    """Append the captured request with its outcome and timing"""
+    record = g.pop('capture', None)
+    if record is not None:
+        try:
+            record['status'] = response.status_code
+            record['ms'] = round((time.monotonic() - g.capture_start) * 1000, 1)
+            if 'voice_source' in g:
+                record['voice'] = g.voice_source
+            line = json.dumps(record, separators=(',', ':')) + '\n'
+            with _capture_lock:
+                with open(TRAFFIC_CAPTURE_FILE, 'a') as f:
+                    f.write(line)
+        except Exception as e:
+            print(f"Error writing traffic capture: {e}", flush=True)
+    return response
 
 @app.route('/tts', methods=['POST'])
 def text_to_speech():
@@ -92,6 +711,11 @@ def text_to_speech():
     try:
         # Get request data from frontend
         data = request.get_json()
+        deadline = _get_tts_deadline()
+        _count_tts_metric('tts_requests')
+
+        # Client-side ID used by /api/cancel-tts; not part of the Fish Audio request
+        client_request_id = data.pop('client_request_id', None) or request.headers.get('X-Client-Request-Id')
 
         print(f"=== Proxy TTS Request ===", flush=True)
         print(f"Text: {data.get('text', '')}", flush=True)
@@ -102,12 +726,15 @@ def text_to_speech():
         print(f"Volume: {data.get('prosody', {}).get('volume', 0)} dB", flush=True)
         
         # Check if user has a cloned voice and use it if available
+        voice_source = 'library' if data.get('reference_id') else 'default'
         user_id = data.get('user_id')
         if user_id:
-            user_voice_id = get_user_voice_id(user_id)
+            user_voice_id = get_user_voice_id(user_id, touch=True)
             if user_voice_id:
                 print(f"Using cloned voice for user {user_id}: {user_voice_id}", flush=True)
                 data['reference_id'] = user_voice_id
+                voice_source = 'cloned'
+        g.voice_source = voice_source
         
         print(f"Full Request Body: {data}", flush=True)
 
@@ -121,40 +748,132 @@ def text_to_speech():
         print(f"Sending to Fish Audio: {FISH_AUDIO_BASE_URL}/tts", flush=True)
         print(f"With data: {data}", flush=True)
 
-        response = requests.post(
-            f'{FISH_AUDIO_BASE_URL}/tts',
-            headers=headers,
-            json=data,
-            timeout=30
-        )
+        call = {
+            'cancel': threading.Event(),
+            'done': threading.Event(),
+            'sock': None
+        }
+        if client_request_id:
+            with _tts_lock:
+                # A reused ID supersedes the older call
+                previous = _tts_in_flight.get(client_request_id)
+                _tts_in_flight[client_request_id] = call
+            if previous is not None:
+                _cancel_tts_call(previous)
+
+        _count_tts_metric('tts_in_flight')
+        try:
+            threading.Thread(
+                target=_fetch_tts_audio,
+                args=(call, data, headers, deadline),
+                name='tts-upstream',
+                daemon=True
+            ).start()
 
-        print(f"Fish Audio Response Status: {response.status_code}", flush=True)
-        print(f"Fish Audio Response Headers: {dict(response.headers)}", flush=True)
+            # Wait for Fish Audio, but give up as soon as the client cancels,
+            # disconnects or the deadline passes
+            client_socket = request.environ.get('werkzeug.socket')
+            stop_reason = None
+            while not call['done'].wait(TTS_CANCEL_POLL_SECONDS):
+                if call['cancel'].is_set():
+                    stop_reason = 'tts_cancelled'
+                elif time.monotonic() >= deadline:
+                    stop_reason = 'tts_deadline_exceeded'
+                elif _client_disconnected(client_socket):
+                    stop_reason = 'tts_client_disconnects'
+                if stop_reason:
+                    _cancel_tts_call(call)
+                    break
+            if not stop_reason and call['cancel'].is_set():
+                stop_reason = 'tts_cancelled'
+        finally:
+            with _tts_lock:
+                _tts_metrics['tts_in_flight'] -= 1
+                if client_request_id and _tts_in_flight.get(client_request_id) is call:
+                    del _tts_in_flight[client_request_id]
 
-        if response.status_code != 200:
-            error_text = response.text
+        if stop_reason:
+            _count_tts_metric(stop_reason)
+            print(f"TTS request stopped early: {stop_reason}", flush=True)
+            if stop_reason == 'tts_deadline_exceeded':
+                return jsonify({'error': 'Fish Audio API deadline exceeded'}), 504
+            return jsonify({'error': 'TTS request cancelled'}), TTS_CANCELLED_STATUS
+
+        if 'exception' in call:
+            raise call['exception']
+
+        print(f"Fish Audio Response Status: {call['status_code']}", flush=True)
+        print(f"Fish Audio Response Headers: {call['headers']}", flush=True)
+
+        if call['status_code'] != 200:
+            error_text = call['error_text']
             print(f"Fish Audio Error: {error_text}")
+            _count_tts_metric('tts_errors')
             return jsonify({
-                'error': f'Fish Audio API error: {response.status_code}',
+                'error': f'Fish Audio API error: {call["status_code"]}',
                 'details': error_text
-            }), response.status_code
+            }), call['status_code']
 
         # Return audio file to frontend
-        audio_data = response.content
-        return send_file(
+        _count_tts_metric('tts_completed')
+        audio_data = call['content']
+        response = send_file(
             io.BytesIO(audio_data),
             mimetype='audio/mpeg',
             as_attachment=False,
             download_name='speech.mp3'
         )
+        # Lets load tests measure cloned-voice lookup hit rates
+        response.headers['X-Voice-Source'] = voice_source
+        return response
 
     except requests.exceptions.RequestException as e:
         print(f"Request Error: {str(e)}")
+        _count_tts_metric('tts_errors')
         return jsonify({'error': 'Failed to connect to Fish Audio API', 'details': str(e)}), 500
     except Exception as e:
         print(f"Server Error: {str(e)}")
+        _count_tts_metric('tts_errors')
         return jsonify({'error': 'Internal server error', 'details': str(e)}), 500
 
+@app.route('/api/cancel-tts', methods=['POST'])
+def cancel_tts():
+    """
+    Abort an in-flight TTS request so its worker is released immediately
+    Body: {"client_request_id": "..."} (the same ID sent with /tts)
+    """
+    try:
+        data = request.get_json() or {}
+        client_request_id = data.get('client_request_id')
+        
+        if not client_request_id:
+            return jsonify({'error': 'client_request_id is required'}), 400
+        
+        with _tts_lock:
+            call = _tts_in_flight.get(client_request_id)
+        
+        if call is not None:
+            _cancel_tts_call(call)
+            print(f"TTS request cancelled: {client_request_id}", flush=True)
+        
+        return jsonify({
+            "success": True,
+            "cancelled": call is not None,
+            "client_request_id": client_request_id
+        })
+    except Exception as e:
+        print(f"Error cancelling TTS request: {e}")
+        return jsonify({
+            'error': 'Failed to cancel TTS request',
+            'details': str(e)
+        }), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """TTS request counters, including work cancelled before completion"""
+    with _tts_lock:
+        return jsonify(dict(_tts_metrics))
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -643,7 +1362,8 @@ def save_voice_id():
         if not voice_id:
             return jsonify({'error': 'Voice ID cannot be empty'}), 400
         
-        save_user_voice_id(user_id, voice_id)
+        if not save_user_voice_id(user_id, voice_id):
+            return jsonify({'error': 'Failed to write voice storage'}), 500
         print(f"Voice ID saved manually for user: {user_id}, voice_id: {voice_id}")
         
         return jsonify({
@@ -690,6 +1410,126 @@ def clear_voice():
             'details': str(e)
         }), 500
 
+@app.route('/api/bulk-voice-status', methods=['POST'])
+def bulk_voice_status():
+    """
+    Look up cloned voice IDs for many users in one call
+    Body: {"user_ids": [...]} (max VOICE_BULK_LIMIT)
+    """
+    try:
+        data = request.get_json() or {}
+        user_ids = data.get('user_ids')
+        
+        if not isinstance(user_ids, list) or not all(isinstance(u, str) for u in user_ids):
+            return jsonify({'error': 'user_ids must be a list of strings'}), 400
+        if len(user_ids) > VOICE_BULK_LIMIT:
+            return jsonify({'error': f'Too many user_ids (max {VOICE_BULK_LIMIT})'}), 400
+        
+        voices = get_user_voice_ids(user_ids)
+        
+        return jsonify({
+            "voices": voices,
+            "found": sum(1 for voice_id in voices.values() if voice_id)
+        })
+    except Exception as e:
+        print(f"Error in bulk voice status: {e}")
+        return jsonify({
+            'error': 'Failed to look up voice IDs',
+            'details': str(e)
+        }), 500
+
+@app.route('/api/export-voices', methods=['GET'])
+def export_voices():
+    """
+    Export all stored voice IDs with their last-used timestamps
+    """
+    try:
+        voices = export_voice_storage()
+        return jsonify({
+            "voices": voices,
+            "count": len(voices)
+        })
+    except Exception as e:
+        print(f"Error exporting voices: {e}")
+        return jsonify({
+            'error': 'Failed to export voices',
+            'details': str(e)
+        }), 500
+
+@app.route('/api/import-voices', methods=['POST'])
+def import_voices():
+    """
+    Import voice IDs for many users at once
+    Body: {"voices": {"user_id": "voice_id", ...}, "replace": false} (max VOICE_IMPORT_LIMIT)
+    Accepts the output of /api/export-voices as well as plain user_id -> voice_id maps;
+    last_used from an export is kept so round trips don't reset expiry.
+    """
+    try:
+        data = request.get_json() or {}
+        voices = data.get('voices')
+        replace = data.get('replace', False)
+        
+        if not isinstance(replace, bool):
+            return jsonify({'error': 'replace must be true or false'}), 400
+        if not isinstance(voices, dict):
+            return jsonify({'error': 'voices must be an object mapping user_id to voice_id'}), 400
+        if len(voices) > VOICE_IMPORT_LIMIT:
+            return jsonify({'error': f'Too many voices (max {VOICE_IMPORT_LIMIT})'}), 400
+        
+        cleaned = {}
+        last_used = {}
+        for user_id, value in voices.items():
+            if not user_id.strip():
+                return jsonify({'error': 'User ID cannot be empty'}), 400
+            # Allow re-importing an export, where each value is {"voice_id", "last_used"}
+            voice_id = value.get('voice_id') if isinstance(value, dict) else value
+            if not isinstance(voice_id, str) or not voice_id.strip():
+                return jsonify({'error': f'Invalid voice ID for user: {user_id}'}), 400
+            cleaned[user_id] = voice_id.strip()
+            if isinstance(value, dict) and value.get('last_used') is not None:
+                timestamp = value['last_used']
+                if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+                    return jsonify({'error': f'Invalid last_used for user: {user_id}'}), 400
+                last_used[user_id] = timestamp
+        
+        if replace:
+            saved = save_voice_storage(cleaned, last_used)
+        else:
+            saved = save_user_voice_ids(cleaned, last_used)
+        
+        if not saved:
+            return jsonify({'error': 'Failed to write voice storage'}), 500
+        
+        print(f"Imported {len(cleaned)} voice IDs (replace={replace})")
+        
+        return jsonify({
+            "success": True,
+            "imported": len(cleaned),
+            "total": count_voice_storage()
+        })
+    except Exception as e:
+        print(f"Error importing voices: {e}")
+        return jsonify({
+            'error': 'Failed to import voices',
+            'details': str(e)
+        }), 500
+
+@app.route('/api/compact-voices', methods=['POST'])
+def compact_voices():
+    """
+    Run voice storage garbage collection and compaction immediately
+    """
+    try:
+        stats = collect_voice_garbage()
+        print(f"Manual voice storage GC: expired {stats['expired']}, {stats['remaining']} remaining")
+        return jsonify({"success": True, **stats})
+    except Exception as e:
+        print(f"Error compacting voices: {e}")
+        return jsonify({
+            'error': 'Failed to compact voice storage',
+            'details': str(e)
+        }), 500
+
 if __name__ == '__main__':
     print("=" * 60)
     print("Fish Audio Proxy Server Starting...")
@@ -698,5 +1538,7 @@ if __name__ == '__main__':
     print(f"Proxy URL: http://localhost:5001/tts")
     print(f"Health Check: http://localhost:5001/health")
     print(f"Voice Cloning: http://localhost:5001/api/create-voice")
+    if TRAFFIC_CAPTURE_FILE:
+        print(f"Capturing traffic to: {TRAFFIC_CAPTURE_FILE}")
     print("=" * 60)
     app.run(host='0.0.0.0', port=5001, debug=True)
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Traffic Replay Tool
+Replays traffic captured by proxy.py (TRAFFIC_CAPTURE_FILE) against a proxy
+instance and reports latency distributions and cloned-voice lookup hit rates.
+
+Usage:
+  1. Start a local Fish Audio stand-in:
+       python replay_traffic.py stand-in --port 5002
+  2. Start the proxy against it:
+       FISH_AUDIO_BASE_URL=http://localhost:5002/v1 python proxy.py
+  3. Replay a capture at 2x speed:
+       python replay_traffic.py replay capture.jsonl --speed 2
+
+A capture file can hold several proxy runs (each with its own hashing salt);
+replay uses the most recent run unless --run is given.
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# Fish Audio stand-in latency model defaults
+STAND_IN_TTS_BASE_MS = 300  # Fixed cost of a TTS call
+STAND_IN_TTS_PER_CHAR_MS = 8  # Extra generation time per character of text
+STAND_IN_SEARCH_MS = 150  # Voice search latency
+STAND_IN_JITTER = 0.2  # +/- fraction of random jitter applied to latencies
+STAND_IN_AUDIO_BYTES_PER_CHAR = 1000  # Roughly 128kbps MP3 at normal speaking rate
+
+PROXY_BULK_LIMIT = 1000  # Matches VOICE_BULK_LIMIT in proxy.py
+
+
+# ========== FISH AUDIO STAND-IN ==========
+def _jittered_sleep(ms, jitter):
+    """Sleep for ms milliseconds with +/- jitter applied"""
+    time.sleep(max(0.0, ms * random.uniform(1 - jitter, 1 + jitter)) / 1000)
+
+def make_stand_in_handler(tts_base_ms, tts_per_char_ms, search_ms, jitter):
+    """Build a request handler that mimics the Fish Audio endpoints the proxy uses"""
+
+    class FishAudioStandIn(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                data = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                self._send_json(400, {'message': 'Invalid JSON'})
+                return
+
+            if not self.path.rstrip('/').endswith('/tts'):
+                self._send_json(404, {'message': 'Not found'})
+                return
+
+            text = data.get('text') or ''
+            _jittered_sleep(tts_base_ms + tts_per_char_ms * len(text), jitter)
+            audio = b'\x00' * max(1, len(text) * STAND_IN_AUDIO_BYTES_PER_CHAR)
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.send_header('Content-Length', str(len(audio)))
+            self.end_headers()
+            try:
+                self.wfile.write(audio)
+            except (BrokenPipeError, ConnectionResetError):
+                # Proxy cancelled the call mid-download
+                pass
+
+        def do_GET(self):
+            # The proxy probes several search endpoints; answer all of them
+            _jittered_sleep(search_ms, jitter)
+            items = [
+                {'_id': f'standin{i:04d}', 'title': f'Stand-in Voice {i}', 'tags': []}
+                for i in range(20)
+            ]
+            self._send_json(200, {'items': items, 'total': len(items)})
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FishAudioStandIn
+
+def run_stand_in(args):
+    """Serve the Fish Audio stand-in until interrupted"""
+    handler = make_stand_in_handler(args.tts_base_ms, args.tts_per_char_ms, args.search_ms, args.jitter)
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    print("=" * 60)
+    print("Fish Audio Stand-in Running...")
+    print(f"Upstream URL: http://{args.host}:{args.port}/v1")
+    print(f"Start the proxy with FISH_AUDIO_BASE_URL=http://{args.host}:{args.port}/v1")
+    print("=" * 60)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# ========== REPLAY DRIVER ==========
+def load_capture(path):
+    """Load captured records sorted by their original arrival time"""
+    records = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Partially written line at the end of a live capture
+                continue
+    records.sort(key=lambda record: record.get('ts', 0))
+    return records
+
+def select_run(records, run=None):
+    """Keep records from one capture run (the latest by default), since hashes differ between runs"""
+    runs = {}
+    for record in records:
+        runs[record.get('run')] = max(runs.get(record.get('run'), 0), record.get('ts', 0))
+    if run is None:
+        run = max(runs, key=runs.get)
+    if len(runs) > 1:
+        print(f"Capture holds {len(runs)} runs: {', '.join(str(r) for r in runs)}; replaying run {run}")
+    return [record for record in records if record.get('run') == run]
+
+def seed_cloned_voices(session, proxy_url, records):
+    """
+    Register a placeholder cloned voice for every user who had one when captured.
+    Returns the user IDs that were added, so they can be removed after the run.
+    """
+    users = sorted({
+        record['user']
+        for record in records
+        if record.get('path') == '/tts' and record.get('voice') == 'cloned' and record.get('user')
+    })
+    missing = []
+    for i in range(0, len(users), PROXY_BULK_LIMIT):
+        response = session.post(
+            f'{proxy_url}/api/bulk-voice-status',
+            json={'user_ids': users[i:i + PROXY_BULK_LIMIT]},
+            timeout=30
+        )
+        response.raise_for_status()
+        missing.extend(user for user, voice_id in response.json()['voices'].items() if not voice_id)
+    if not missing:
+        return []
+    voices = {user: f"replay-{user}" for user in missing}
+    response = session.post(f'{proxy_url}/api/import-voices', json={'voices': voices}, timeout=60)
+    response.raise_for_status()
+    return missing
+
+def remove_seeded_voices(session, proxy_url, users):
+    """Delete placeholder voices added by seed_cloned_voices, returning how many failed"""
+    failed = 0
+    for user in users:
+        try:
+            response = session.post(f'{proxy_url}/api/clear-voice', json={'user_id': user}, timeout=30)
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
+            failed += 1
+    return failed
+
+def attach_cancellations(records):
+    """
+    Fold captured cancels into the /tts requests they aborted so replay cancels
+    them the same time after sending. /tts requests that ended in 499 without a
+    cancel call were client disconnects; replay drops the connection instead.
+    """
+    tts_by_cid = {}
+    cancelled = set()
+    remaining = []
+    for record in records:
+        if record['path'] == '/tts' and record.get('cid'):
+            tts_by_cid[record['cid']] = record
+        if record['path'] == '/api/cancel-tts' and record.get('cid') in tts_by_cid:
+            tts = tts_by_cid[record['cid']]
+            tts['cancel_after'] = max(0.0, record.get('ts', 0) - tts.get('ts', 0))
+            cancelled.add(id(tts))
+            continue
+        remaining.append(record)
+    for record in remaining:
+        if record['path'] == '/tts' and record.get('status') == 499 and id(record) not in cancelled:
+            record['disconnect_after'] = (record.get('ms') or 0) / 1000
+    return remaining
+
+def build_request(record):
+    """Turn a captured record back into request arguments"""
+    if record['path'] == '/api/cancel-tts':
+        return 'POST', {'json': {'client_request_id': record.get('cid')}}
+    if record['path'] == '/tts':
+        body = {
+            'text': record.get('text') or 'x',
+            'prosody': record.get('prosody') or {'speed': 1.0, 'volume': 0},
+            'user_id': record.get('user')
+        }
+        if record.get('ref'):
+            body['reference_id'] = record['ref']
+        for key in ('format', 'mp3_bitrate', 'normalize'):
+            if record.get(key) is not None:
+                body[key] = record[key]
+        if record.get('cid'):
+            body['client_request_id'] = record['cid']
+        headers = {}
+        if record.get('timeout_ms') is not None:
+            headers['X-Request-Timeout-Ms'] = str(record['timeout_ms'])
+        return 'POST', {'json': body, 'headers': headers}
+
+    params = {'title': record.get('title', '')}
+    if record.get('tags'):
+        params['tags'] = record['tags']
+    if record.get('language'):
+        params['language'] = record['language']
+    return 'GET', {'params': params}
+
+def send_request(session, proxy_url, record, timeout, scheduled_at):
+    """Issue one replayed request and measure it"""
+    method, kwargs = build_request(record)
+    started = time.monotonic()
+    result = {
+        'path': record['path'],
+        'lag_ms': (started - scheduled_at) * 1000,
+        'captured_ms': record.get('ms'),
+        'captured_status': record.get('status'),
+        'captured_voice': record.get('voice')
+    }
+    # Cancels and disconnects keep their captured delay after the request started;
+    # --speed only compresses the gaps between requests, not how long users waited
+    cancel_timer = None
+    if record.get('cancel_after') is not None:
+        cancel_timer = threading.Timer(
+            record['cancel_after'],
+            _send_cancel,
+            args=(proxy_url, record['cid'], timeout)
+        )
+        cancel_timer.daemon = True
+        cancel_timer.start()
+    if record.get('disconnect_after') is not None:
+        # A read timeout makes requests drop the connection, which the proxy sees as a disconnect
+        timeout = (timeout, max(0.01, record['disconnect_after']))
+    try:
+        response = session.request(method, f"{proxy_url}{record['path']}", timeout=timeout, **kwargs)
+        result['bytes'] = len(response.content)
+        result['status'] = response.status_code
+        result['voice'] = response.headers.get('X-Voice-Source')
+    except requests.exceptions.ReadTimeout as e:
+        result['status'] = 'client disconnect' if record.get('disconnect_after') is not None else None
+        result['error'] = str(e)
+    except requests.exceptions.RequestException as e:
+        result['status'] = None
+        result['error'] = str(e)
+    finally:
+        if cancel_timer is not None:
+            cancel_timer.cancel()
+    result['ms'] = (time.monotonic() - started) * 1000
+    return result
+
+def _send_cancel(proxy_url, client_request_id, timeout):
+    """Cancel a replayed /tts request, as the captured client did"""
+    try:
+        requests.post(
+            f'{proxy_url}/api/cancel-tts',
+            json={'client_request_id': client_request_id},
+            timeout=timeout
+        )
+    except requests.exceptions.RequestException:
+        pass
+
+def replay(records, proxy_url, speed, concurrency, timeout):
+    """Re-issue records on their original schedule, compressed by speed"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    results = []
+    results_lock = threading.Lock()
+
+    def run(record, scheduled_at):
+        result = send_request(session, proxy_url, record, timeout, scheduled_at)
+        with results_lock:
+            results.append(result)
+
+    first_ts = records[0].get('ts', 0)
+    replay_start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for record in records:
+            scheduled_at = replay_start + (record.get('ts', 0) - first_ts) / speed
+            delay = scheduled_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run, record, scheduled_at)
+    return results, time.monotonic() - replay_start
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def _format_ms(value):
+    return '-' if value is None else f'{value:.0f}'
+
+def print_report(results, elapsed, speed):
+    """
+    Print per-endpoint latency distribution, error counts and lookup hit rates.
+    Latencies and hit rates compare only requests that succeeded (200) both when
+    captured and on replay, so cancellations, timeouts and replay errors on
+    either side don't skew the comparison.
+    """
+    print("=" * 60)
+    print(f"Replayed {len(results)} requests in {elapsed:.1f}s at {speed}x ({len(results) / max(elapsed, 1e-9):.1f} req/s)")
+    print("=" * 60)
+
+    for path in sorted({result['path'] for result in results}):
+        path_results = [result for result in results if result['path'] == path]
+        ok = [result for result in path_results if result.get('status') == 200]
+        both_ok = [result for result in ok if result.get('captured_status') == 200]
+        latencies = [result['ms'] for result in both_ok]
+        captured = [result['captured_ms'] for result in both_ok if result.get('captured_ms') is not None]
+        errors = len(path_results) - len(ok)
+
+        print(f"{path}: {len(path_results)} requests, {errors} non-200, "
+              f"{len(both_ok)} successful when captured and replayed")
+        print(f"  replay   p50 {_format_ms(percentile(latencies, 50))}ms  "
+              f"p90 {_format_ms(percentile(latencies, 90))}ms  "
+              f"p99 {_format_ms(percentile(latencies, 99))}ms  "
+              f"max {_format_ms(max(latencies) if latencies else None)}ms")
+        print(f"  captured p50 {_format_ms(percentile(captured, 50))}ms  "
+              f"p90 {_format_ms(percentile(captured, 90))}ms  "
+              f"p99 {_format_ms(percentile(captured, 99))}ms")
+
+        status_counts = {}
+        for result in path_results:
+            status = result.get('status') or 'connection error'
+            status_counts[status] = status_counts.get(status, 0) + 1
+        print(f"  statuses {status_counts}")
+
+        if path == '/tts' and both_ok:
+            captured_hits = sum(1 for result in both_ok if result.get('captured_voice') == 'cloned')
+            replay_hits = sum(1 for result in both_ok if result.get('voice') == 'cloned')
+            print(f"  cloned-voice lookup hit rate: captured {captured_hits / len(both_ok):.1%}, "
+                  f"replay {replay_hits / len(both_ok):.1%}")
+
+    lags = [result['lag_ms'] for result in results]
+    print(f"Dispatch lag p99 {_format_ms(percentile(lags, 99))}ms "
+          f"(high values mean --concurrency is too low for this speed)")
+
+def run_replay(args):
+    """Load a capture, optionally seed cloned voices, replay it and report"""
+    records = [record for record in load_capture(args.capture_file) if record.get('path')]
+    if records:
+        records = select_run(records, args.run)
+    if args.limit:
+        records = records[:args.limit]
+    records = attach_cancellations(records)
+    if not records:
+        print("No records to replay")
+        return 1
+
+    proxy_url = args.proxy.rstrip('/')
+    print(f"Loaded {len(records)} records from {args.capture_file}")
+
+    session = requests.Session()
+    seeded = []
+    if args.seed_voices:
+        seeded = seed_cloned_voices(session, proxy_url, records)
+        print(f"Seeded {len(seeded)} cloned voices on {proxy_url}")
+
+    try:
+        results, elapsed = replay(records, proxy_url, args.speed, args.concurrency, args.timeout)
+    finally:
+        if seeded:
+            failed = remove_seeded_voices(session, proxy_url, seeded)
+            print(f"Removed {len(seeded) - failed} seeded voices" + (f", {failed} failed" if failed else ""))
+    print_report(results, elapsed, args.speed)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured proxy traffic for load testing')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    stand_in = subparsers.add_parser('stand-in', help='Run a local Fish Audio stand-in upstream')
+    stand_in.add_argument('--host', default='localhost')
+    stand_in.add_argument('--port', type=int, default=5002)
+    stand_in.add_argument('--tts-base-ms', type=float, default=STAND_IN_TTS_BASE_MS)
+    stand_in.add_argument('--tts-per-char-ms', type=float, default=STAND_IN_TTS_PER_CHAR_MS)
+    stand_in.add_argument('--search-ms', type=float, default=STAND_IN_SEARCH_MS)
+    stand_in.add_argument('--jitter', type=float, default=STAND_IN_JITTER)
+
+    replay_parser = subparsers.add_parser('replay', help='Replay a capture file against a proxy')
+    replay_parser.add_argument('capture_file')
+    replay_parser.add_argument('--proxy', default='http://localhost:5001')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help='Replay speed multiplier (e.g. 2 = twice as fast)')
+    replay_parser.add_argument('--concurrency', type=int, default=64, help='Max requests in flight')
+    replay_parser.add_argument('--timeout', type=float, default=60, help='Per-request timeout in seconds')
+    replay_parser.add_argument('--limit', type=int, default=0, help='Only replay the first N records')
+    replay_parser.add_argument('--run', help='Capture run ID to replay (default: most recent run in the file)')
+    replay_parser.add_argument('--seed-voices', action='store_true',
+                               help='Import placeholder cloned voices so captured lookup hits also hit on replay; '
+                                    'they are removed afterwards, but prefer a throwaway proxy in case the run is killed')
+
+    args = parser.parse_args()
+    if args.command == 'stand-in':
+        run_stand_in(args)
+        return 0
+    if args.speed <= 0:
+        parser.error('--speed must be positive')
+    return run_replay(args)
+
+if __name__ == '__main__':
+    raise SystemExit(main())